@@ -1,49 +1,194 @@
 import os
+import re
+import atexit
+import base64
 import time
+import gzip
 import json
+import hmac
+import random
+import hashlib
+import secrets
 import logging
-from io import BytesIO
-from collections import defaultdict
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 
+import httpx
+import orjson
 import telebot
 from telebot import apihelper
-from telebot.types import ReplyKeyboardMarkup, KeyboardButton
+from telebot.types import ReplyKeyboardMarkup, KeyboardButton, Update
 from dotenv import load_dotenv
-from mistralai import Mistral
+from mistralai import Mistral, models
 
 from resume_renderer import render_resume_html, html_to_pdf_bytes
+from ttl_cache import TTLCache
 
 # ---------- Logging setup ----------
 logging.basicConfig(
-    level=logging.INFO,
+    level=os.getenv("LOG_LEVEL", "INFO").upper(),
     format='%(asctime)s | %(levelname)s | %(message)s',
     datefmt='%Y-%m-%d %H:%M:%S'
 )
 logger = logging.getLogger(__name__)
 
+# ---------- Fonts ----------
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+FONTS_DIR = os.path.join(BASE_DIR, "assets", "fonts")
+FONT_FILES = {
+    "font_roboto_regular": "Roboto-Regular.ttf",
+    "font_roboto_bold": "Roboto-Bold.ttf",
+    "font_roboto_italic": "Roboto-Italic.ttf",
+}
+
+
+def load_fonts() -> dict:
+    """
+    Читает шрифты и кодирует их в base64 для встраивания в HTML-шаблон.
+    """
+    fonts = {}
+    for key, file_name in FONT_FILES.items():
+        with open(os.path.join(FONTS_DIR, file_name), "rb") as f:
+            fonts[key] = base64.b64encode(f.read()).decode("utf-8")
+    return fonts
+
+
+# Шрифты статичны: кодируются один раз при старте, отсутствие файла - ошибка запуска, а не запроса
+RESUME_FONTS = load_fonts()
+logger.info("Fonts loaded: %s", ", ".join(FONT_FILES.values()))
+
 # ---------- Session storage ----------
-user_sessions = defaultdict(lambda: {"texts": []})
+SESSION_MAX_USERS = 10_000
+SESSION_TTL = 60 * 60
+# Ограничение объёма текста в сессии: держит размер промпта и память на пользователя предсказуемыми
+SESSION_MAX_CHARS = 20_000
+SESSION_MAX_TEXTS = 100
+
+user_sessions = TTLCache(maxsize=SESSION_MAX_USERS, ttl=SESSION_TTL)
+
+
+def new_session() -> dict:
+    # size - суммарная длина texts, поддерживается при добавлении и удалении;
+    # lock - сообщения одного пользователя обрабатываются разными потоками пула
+    return {"texts": [], "size": 0, "lock": threading.Lock()}
+
+
+def get_session(user_id: int) -> dict:
+    return user_sessions.get_or_create(user_id, new_session)
+
+
+def take_session_texts(session: dict) -> list:
+    """
+    Забирает накопленные тексты и очищает сессию.
+    """
+    with session["lock"]:
+        texts = session["texts"]
+        session["texts"] = []
+        session["size"] = 0
+    return texts
+
+
+def restore_session_texts(session: dict, texts: list):
+    """
+    Возвращает забранные тексты в начало сессии, перед присланными после них.
+    """
+    with session["lock"]:
+        session["texts"] = texts + session["texts"]
+        session["size"] += sum(len(text) for text in texts)
+
 
 # ---------- Load env ----------
 load_dotenv()
 TELEGRAM_TOKEN = os.getenv("TELEGRAM_TOKEN")
 MISTRAL_API_KEY = os.getenv("MISTRAL_API_KEY", "")
+BOT_WORKER_THREADS = int(os.getenv("BOT_WORKER_THREADS", "8"))
+MISTRAL_MAX_CONCURRENCY = int(os.getenv("MISTRAL_MAX_CONCURRENCY", "4"))
+GENERATION_WORKERS = int(os.getenv("GENERATION_WORKERS", "8"))
+PDF_WORKERS = int(os.getenv("PDF_WORKERS", "4"))
+PROGRESS_WORKERS = int(os.getenv("PROGRESS_WORKERS", "4"))
+
+# Webhook-режим включается, если задан публичный HTTPS-адрес (TLS терминируется снаружи)
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "").rstrip("/")
+WEBHOOK_PATH = "/webhook"
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8080"))
+# Без секрета любой, кто видит порт, мог бы присылать поддельные обновления: если он не задан,
+# генерируется случайный на время жизни процесса и передаётся в set_webhook
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET") or secrets.token_urlsafe(32)
+
+# Максимальное время ожидания getUpdates на стороне Telegram: меньше пустых циклов опроса
+LONG_POLLING_TIMEOUT = 50
 
 # <<< Настраиваем прокси для подключения к нашему новому контейнеру
 apihelper.proxy = {'https': 'socks5h://proxy:1080'}
 logger.info("Using internal proxy at socks5h://proxy:1080")
 
-bot = telebot.TeleBot(TELEGRAM_TOKEN)
+# requests-сессия на поток живёт час: keep-alive соединения через прокси переиспользуются между вызовами API
+apihelper.SESSION_TIME_TO_LIVE = 60 * 60
+apihelper.CONNECT_TIMEOUT = 10
+# Повтор запроса при обрыве соединения или таймауте прокси вместо потери сообщения
+apihelper.RETRY_ON_ERROR = True
+apihelper.RETRY_TIMEOUT = 2
+
+# Обработчики выполняются в пуле потоков: долгий вызов LLM одного пользователя не блокирует остальных
+bot = telebot.TeleBot(TELEGRAM_TOKEN, threaded=True, num_threads=BOT_WORKER_THREADS)
+
+# Генерация (LLM + PDF) идёт в отдельном пуле, обработчики обновлений сразу освобождаются
+generation_executor = ThreadPoolExecutor(max_workers=GENERATION_WORKERS, thread_name_prefix="generate")
+# Отдельный пул для PDF: задачи генерации ждут его результат, общий пул мог бы заблокироваться
+pdf_executor = ThreadPoolExecutor(max_workers=PDF_WORKERS, thread_name_prefix="pdf")
+# Правки статусного сообщения с прогрессом: медленный Telegram не задерживает чтение стрима Mistral
+progress_executor = ThreadPoolExecutor(max_workers=PROGRESS_WORKERS, thread_name_prefix="progress")
+
+# Один клиент на процесс: httpx-пул соединений переиспользуется между потоками обработчиков
+mistral_client = Mistral(api_key=MISTRAL_API_KEY)
+atexit.register(mistral_client.__exit__, None, None, None)
 
 TELEGRAM_MESSAGE_LIMIT = 4000
+MARKDOWN_MESSAGE_HEADER = "📄 *Your Resume (Markdown)*\n\n"
+CODE_BLOCK_OVERHEAD = len("```markdown\n\n```")
+# Очень длинный Markdown отправляется сжатым: текст жмётся в 4-8 раз, загрузка через прокси быстрее
+MARKDOWN_GZIP_THRESHOLD = 32_000
 COVER_LETTER_MAX_CHARS = 1200
 
+MISTRAL_MODEL = "mistral-small-latest"
+MISTRAL_CACHE_SIZE = 512
+MISTRAL_CACHE_TTL = 60 * 60
+# Повтор при 429/5xx и сетевых ошибках: экспоненциальная задержка со случайным разбросом
+MISTRAL_MAX_ATTEMPTS = 4
+MISTRAL_RETRY_BASE_DELAY = 0.5
+MISTRAL_RETRY_MAX_DELAY = 8
+# Telegram ограничивает частоту редактирования сообщений, поэтому прогресс обновляется не чаще раза в интервал
+STREAM_PROGRESS_INTERVAL = 1.5
+
+# Batch API: генерация со скидкой, результат приходит с задержкой
+BATCH_POLL_INTERVAL = 30
+BATCH_FAILED_STATUSES = {"FAILED", "TIMEOUT_EXCEEDED", "CANCELLED"}
+BATCH_PENDING_STATUSES = {"QUEUED", "RUNNING", "CANCELLATION_REQUESTED"}
+BATCH_LIST_PAGE_SIZE = 100
+
+# ---------- Mistral response cache ----------
+mistral_cache = TTLCache(maxsize=MISTRAL_CACHE_SIZE, ttl=MISTRAL_CACHE_TTL)
+# Запросы, которые уже выполняются: повторный идентичный промпт ждёт результат первого
+mistral_inflight = {}
+mistral_inflight_lock = threading.Lock()
+# Ограничение одновременных запросов к API, чтобы всплеск нажатий не упирался в rate limit
+mistral_slots = threading.BoundedSemaphore(MISTRAL_MAX_CONCURRENCY)
+
+# ---------- Batch jobs ----------
+# job_id -> (chat_id, status_message_id)
+pending_batch_jobs = {}
+pending_batch_jobs_lock = threading.Lock()
+
 # ---------- Prompt ----------
+# Статичные инструкции отправляются system-сообщением, а пользовательский текст - отдельным
+# user-сообщением: префикс запроса одинаков для всех пользователей (prefix caching на стороне API)
 RESUME_JSON_PROMPT = f"""
 You are a professional resume analyst and career coach.
 
-INPUT (raw user messages):
-{{user_text}}
+INPUT:
+The user message contains raw user messages with their experience and resume details.
 
 GOAL:
 Return a SINGLE valid JSON object with:
@@ -106,22 +251,120 @@ JSON SCHEMA (exact keys):
 """.strip()
 
 
-def call_mistral(prompt: str, chat_id: int = None) -> str:
+def build_resume_messages(user_text: str) -> list:
+    return [
+        {"role": "system", "content": RESUME_JSON_PROMPT},
+        {"role": "user", "content": user_text},
+    ]
+
+
+# Только пробелы внутри строки: отступ в начале строки задаёт вложенность списков и сохраняется
+_INLINE_SPACE_RE = re.compile(r"(?<=\S)[ \t\u00a0]+")
+_BLANK_LINES_RE = re.compile(r"\n{3,}")
+
+
+def normalize_user_text(text: str) -> str:
+    """
+    Приводит пробелы и пустые строки к единому виду, чтобы одинаковые по смыслу
+    вводы давали одинаковый промпт и попадали в кэш ответов.
+    """
+    lines = (_INLINE_SPACE_RE.sub(" ", line).rstrip() for line in text.splitlines())
+    return _BLANK_LINES_RE.sub("\n\n", "\n".join(lines)).strip("\n")
+
+
+def _mistral_cache_key(model: str, messages: list) -> str:
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(model.encode("utf-8"))
+    for message in messages:
+        digest.update(b"\0" + message["role"].encode("utf-8") + b"\0")
+        digest.update(message["content"].encode("utf-8"))
+    return digest.hexdigest()
+
+
+def _is_retryable_mistral_error(error: Exception) -> bool:
+    if isinstance(error, models.SDKError):
+        return error.status_code == 429 or error.status_code >= 500
+    return isinstance(error, httpx.TransportError)
+
+
+def _stream_mistral(messages: list, on_progress=None) -> str:
+    parts = []
+    received = 0
+    with mistral_slots:
+        for chunk in mistral_client.chat.stream(
+            model=MISTRAL_MODEL,
+            messages=messages
+        ):
+            delta = chunk.data.choices[0].delta.content
+            if not isinstance(delta, str) or not delta:
+                continue
+            parts.append(delta)
+            received += len(delta)
+            if on_progress:
+                on_progress(received)
+    return "".join(parts)
+
+
+def _request_mistral(messages: list, log_prefix: str, on_progress=None) -> str:
+    for attempt in range(1, MISTRAL_MAX_ATTEMPTS + 1):
+        logger.info("%s Calling Mistral API (streaming), attempt %d...", log_prefix, attempt)
+        try:
+            content = _stream_mistral(messages, on_progress)
+            logger.info("%s Mistral API response received successfully", log_prefix)
+            return content
+        except Exception as e:
+            if attempt == MISTRAL_MAX_ATTEMPTS or not _is_retryable_mistral_error(e):
+                logger.error("%s Mistral API error: %s", log_prefix, e)
+                raise
+            delay = random.uniform(0, min(MISTRAL_RETRY_MAX_DELAY, MISTRAL_RETRY_BASE_DELAY * 2 ** attempt))
+            logger.warning("%s Mistral API transient error: %s. Retrying in %.1f s", log_prefix, e, delay)
+            time.sleep(delay)
+
+
+def call_mistral(messages: list, chat_id: int = None, on_progress=None, parse=None):
+    """
+    Запрашивает ответ модели с кэшем и объединением одинаковых запросов.
+    Если передан parse, возвращается его результат, а в кэш попадает только ответ,
+    который parse разобрал без ошибки: повторная попытка после битого ответа снова идёт в API.
+    """
     log_prefix = f"[chat:{chat_id}]" if chat_id else "[no_chat]"
-    logger.info(f"{log_prefix} Calling Mistral API...")
+
+    cache_key = _mistral_cache_key(MISTRAL_MODEL, messages)
+
+    # Кэш проверяется под той же блокировкой, что и выполняющиеся запросы: владелец сохраняет
+    # ответ до снятия своей записи, поэтому между промахом и созданием Future дубль не возникнет
+    with mistral_inflight_lock:
+        cached = mistral_cache.get(cache_key)
+        future = mistral_inflight.get(cache_key)
+        is_owner = cached is None and future is None
+        if is_owner:
+            future = Future()
+            mistral_inflight[cache_key] = future
+
+    if cached is not None:
+        logger.info("%s Mistral response served from cache", log_prefix)
+        return parse(cached) if parse else cached
+
+    if not is_owner:
+        logger.info("%s Identical Mistral request in flight, waiting for its result", log_prefix)
+        content = future.result()
+        return parse(content) if parse else content
 
     try:
-        with Mistral(api_key=MISTRAL_API_KEY) as mistral:
-            resp = mistral.chat.complete(
-                model="mistral-small-latest",
-                messages=[{"role": "user", "content": prompt}],
-                stream=False
-            )
-            logger.info(f"{log_prefix} Mistral API response received successfully")
-            return resp.choices[0].message.content
+        content = _request_mistral(messages, log_prefix, on_progress)
+        result = parse(content) if parse else content
+        mistral_cache.set(cache_key, content)
+        future.set_result(content)
+        return result
     except Exception as e:
-        logger.error(f"{log_prefix} Mistral API error: {e}")
+        future.set_exception(e)
         raise
+    finally:
+        with mistral_inflight_lock:
+            mistral_inflight.pop(cache_key, None)
+
+
+_json_decoder = json.JSONDecoder()
 
 
 def extract_json(text: str, chat_id: int = None) -> dict:
@@ -129,255 +372,516 @@ def extract_json(text: str, chat_id: int = None) -> dict:
     Достаёт первый JSON-объект из строки.
     """
     log_prefix = f"[chat:{chat_id}]" if chat_id else "[no_chat]"
-    logger.info(f"{log_prefix} Extracting JSON from response...")
+    logger.info("%s Extracting JSON from response...", log_prefix)
 
     start = text.find("{")
-    end = text.rfind("}")
-    if start == -1 or end == -1 or end <= start:
-        logger.error(f"{log_prefix} No JSON object found in model output")
-        logger.debug(f"{log_prefix} Raw text was: {text[:500]}...")
+    if start == -1:
+        logger.error("%s No JSON object found in model output", log_prefix)
+        logger.debug("%s Raw text was: %s...", log_prefix, text[:500])
         raise ValueError("No JSON object found in model output")
 
     try:
-        result = json.loads(text[start:end + 1])
-        logger.info(f"{log_prefix} JSON extracted successfully")
+        # raw_decode разбирает один объект с позиции start и игнорирует хвост после него
+        # (например, закрывающий ```): один проход без копирования среза
+        result, _ = _json_decoder.raw_decode(text, start)
+        logger.info("%s JSON extracted successfully", log_prefix)
         return result
     except json.JSONDecodeError as e:
-        logger.error(f"{log_prefix} JSON decode error: {e}")
+        logger.error("%s JSON decode error: %s", log_prefix, e)
         raise
 
 
 # ---------- Keyboard ----------
-def generate_keyboard():
-    kb = ReplyKeyboardMarkup(resize_keyboard=True)
-    kb.add(
-        KeyboardButton("✅ Сгенерировать резюме"),
-        KeyboardButton("❌ Очистить ввод")
-    )
-    return kb
+BTN_GENERATE = "✅ Сгенерировать резюме"
+BTN_GENERATE_BATCH = "🕐 Дешёвая генерация"
+BTN_CLEAR = "❌ Очистить ввод"
+BUTTON_TEXTS = frozenset((BTN_GENERATE, BTN_GENERATE_BATCH, BTN_CLEAR))
+
+# Клавиатура не меняется, поэтому собирается один раз и переиспользуется во всех ответах
+MAIN_KEYBOARD = ReplyKeyboardMarkup(resize_keyboard=True)
+MAIN_KEYBOARD.add(
+    KeyboardButton(BTN_GENERATE),
+    KeyboardButton(BTN_GENERATE_BATCH),
+    KeyboardButton(BTN_CLEAR)
+)
 
 
 # ---------- Handlers ----------
 @bot.message_handler(commands=["start"])
 def start(message):
     chat_id = message.chat.id
-    logger.info(f"[chat:{chat_id}] /start command received")
+    logger.info("[chat:%s] /start command received", chat_id)
     bot.send_message(
         chat_id,
         "Welcome to ResumeFlow!\n\n"
         "Send your experience/resume text in single or multiple messages.\n"
-        "When finished, press «✅ Сгенерировать резюме».",
-        reply_markup=generate_keyboard()
+        f"When finished, press «{BTN_GENERATE}».\n"
+        f"Not in a hurry? «{BTN_GENERATE_BATCH}» delivers the same result within minutes.",
+        reply_markup=MAIN_KEYBOARD
     )
 
 
-@bot.message_handler(func=lambda m: m.text not in ["✅ Сгенерировать резюме", "❌ Очистить ввод"])
+@bot.message_handler(func=lambda m: m.text not in BUTTON_TEXTS)
 def collect_text(message):
     user_id = message.from_user.id
     chat_id = message.chat.id
     text = (message.text or "").strip()
 
-    logger.info(f"[chat:{chat_id}] Text message received from user {user_id}, length: {len(text)} chars")
+    logger.info("[chat:%s] Text message received from user %s, length: %d chars", chat_id, user_id, len(text))
 
     if not text:
-        logger.warning(f"[chat:{chat_id}] Empty text received, ignoring")
+        logger.warning("[chat:%s] Empty text received, ignoring", chat_id)
         return
 
-    user_sessions[user_id]["texts"].append(text)
-    logger.info(
-        f"[chat:{chat_id}] Text added to session. Total texts in session: {len(user_sessions[user_id]['texts'])}")
+    session = get_session(user_id)
+    with session["lock"]:
+        texts = session["texts"]
+        texts.append(text)
+        session["size"] += len(text)
 
-    bot.send_message(
-        chat_id,
-        "Текст добавлен. Можете отправить ещё или нажмите «Сгенерировать резюме».",
-        reply_markup=generate_keyboard()
-    )
+        trimmed = 0
+        while len(texts) > SESSION_MAX_TEXTS or (len(texts) > 1 and session["size"] > SESSION_MAX_CHARS):
+            session["size"] -= len(texts.pop(0))
+            trimmed += 1
+        texts_count = len(texts)
+
+    if trimmed:
+        logger.warning("[chat:%s] Session size limit reached, dropped %d oldest texts", chat_id, trimmed)
+
+    logger.info("[chat:%s] Text added to session. Total texts in session: %d", chat_id, texts_count)
+
+    reply = "Текст добавлен. Можете отправить ещё или нажмите «Сгенерировать резюме»."
+    if trimmed:
+        reply = f"⚠️ Превышен лимит объёма ввода, самые старые сообщения удалены.\n\n{reply}"
+    bot.send_message(chat_id, reply, reply_markup=MAIN_KEYBOARD)
 
 
-@bot.message_handler(func=lambda m: m.text == "❌ Очистить ввод")
+@bot.message_handler(func=lambda m: m.text == BTN_CLEAR)
 def clear_input(message):
     user_id = message.from_user.id
     chat_id = message.chat.id
 
-    texts_count = len(user_sessions[user_id]["texts"])
-    user_sessions[user_id]["texts"].clear()
+    texts_count = len(take_session_texts(get_session(user_id)))
 
-    logger.info(f"[chat:{chat_id}] Input cleared. Removed {texts_count} texts from session")
-    bot.send_message(chat_id, "Ввод очищен.", reply_markup=generate_keyboard())
+    logger.info("[chat:%s] Input cleared. Removed %d texts from session", chat_id, texts_count)
+    bot.send_message(chat_id, "Ввод очищен.", reply_markup=MAIN_KEYBOARD)
 
 
-def wrap_markdown_code_block(md: str) -> str:
+class StreamProgressReporter:
+    """
+    Показывает в статусном сообщении, сколько символов уже сгенерировано.
+    Вызывается из цикла чтения стрима и только запоминает счётчик: правка сообщения
+    уходит в progress_executor, и одновременно выполняется не больше одной.
+    """
+
+    def __init__(self, chat_id: int, message_id: int):
+        self.chat_id = chat_id
+        self.message_id = message_id
+        self._last_edit = 0.0
+        self._pending = None
+
+    def __call__(self, received_chars: int):
+        now = time.monotonic()
+        if now - self._last_edit < STREAM_PROGRESS_INTERVAL:
+            return
+        if self._pending is not None and not self._pending.done():
+            return
+        self._last_edit = now
+        self._pending = progress_executor.submit(self._edit, received_chars)
+
+    def _edit(self, received_chars: int):
+        try:
+            bot.edit_message_text(f"⏳ Генерирую резюме... получено {received_chars} символов",
+                                  self.chat_id, self.message_id)
+        except Exception as e:
+            logger.debug("[chat:%s] Progress update skipped: %s", self.chat_id, e)
+
+    def wait(self):
+        """
+        Дожидается последней правки, чтобы она не перезаписала следующие статусы.
+        """
+        if self._pending is not None:
+            self._pending.result()
+
+
+def wrap_markdown_code_block(md: str, limit: int) -> str | None:
     """
     Оборачивает Markdown-текст в code block для Telegram.
+    Возвращает None, если текст сам содержит code block или результат длиннее limit.
     """
-    if "```" in md:
-        return ""
+    if "```" in md or len(md) + CODE_BLOCK_OVERHEAD > limit:
+        return None
     return f"```markdown\n{md}\n```"
 
 
-@bot.message_handler(func=lambda m: m.text == "✅ Сгенерировать резюме")
+# Всё, кроме букв/цифр любого алфавита, "_" и пробела: кириллические имена сохраняются
+_UNSAFE_FILENAME_RE = re.compile(r"[^\w ]")
+
+
+def build_resume_pdf(resume_data: dict, chat_id: int) -> bytes:
+    """
+    Рендерит HTML-шаблон со встроенными шрифтами и конвертирует его в PDF.
+    """
+    # Шрифты загружены при старте
+    context = {**resume_data, **RESUME_FONTS}
+
+    logger.info("[chat:%s] Rendering HTML template...", chat_id)
+    try:
+        rendered_html = render_resume_html(context)
+        logger.info("[chat:%s] HTML rendered successfully, length: %d chars", chat_id, len(rendered_html))
+    except Exception as e:
+        logger.error("[chat:%s] HTML rendering error: %s", chat_id, e)
+        raise
+
+    logger.info("[chat:%s] Converting HTML to PDF...", chat_id)
+    try:
+        pdf_bytes = html_to_pdf_bytes(rendered_html)
+        logger.info("[chat:%s] PDF generated successfully, size: %d bytes", chat_id, len(pdf_bytes))
+    except Exception as e:
+        logger.error("[chat:%s] PDF conversion error: %s", chat_id, e)
+        raise
+
+    return pdf_bytes
+
+
+def deliver_resume(chat_id: int, status_message_id: int, payload: dict):
+    """
+    Отправляет пользователю Markdown-резюме, cover letter и PDF из ответа модели.
+    """
+    resume_markdown = (payload.get("resume_markdown") or "").strip()
+    cover_letter = (payload.get("cover_letter") or "").strip()
+    resume_data = payload.get("resume_data") or {}
+
+    logger.info("[chat:%s] Parsed data - markdown: %d chars, cover_letter: %d chars",
+                chat_id, len(resume_markdown), len(cover_letter))
+    logger.info("[chat:%s] resume_data keys: %s", chat_id, list(resume_data.keys()))
+    logger.info("[chat:%s] full_name in resume_data: '%s'", chat_id, resume_data.get('full_name', 'NOT FOUND'))
+
+    # PDF - самый долгий шаг: запускается сразу и рендерится, пока уходят текстовые версии
+    pdf_future = None
+    if resume_data.get("full_name"):
+        logger.info("[chat:%s] full_name found, starting PDF generation in background...", chat_id)
+        pdf_future = pdf_executor.submit(build_resume_pdf, resume_data, chat_id)
+
+    # 3) Отправка резюме в Markdown
+    logger.info("[chat:%s] Step 3: Sending Markdown version...", chat_id)
+
+    if not resume_markdown:
+        logger.warning("[chat:%s] resume_markdown is empty!", chat_id)
+        bot.send_message(chat_id, "⚠️ Не удалось получить resume_markdown из JSON.")
+    else:
+        code_block = wrap_markdown_code_block(resume_markdown, TELEGRAM_MESSAGE_LIMIT - len(MARKDOWN_MESSAGE_HEADER))
+        if code_block is None:
+            logger.info("[chat:%s] Sending markdown as file (too long or contains code blocks)", chat_id)
+            markdown_bytes = resume_markdown.encode("utf-8")
+            file_name = "resume.md"
+            if len(resume_markdown) > MARKDOWN_GZIP_THRESHOLD:
+                markdown_bytes = gzip.compress(markdown_bytes, compresslevel=6)
+                file_name = "resume.md.gz"
+            bot.send_document(chat_id, markdown_bytes, visible_file_name=file_name,
+                              caption="📄 Ваше резюме (Markdown файл)")
+        else:
+            logger.info("[chat:%s] Sending markdown as message", chat_id)
+            bot.send_message(chat_id, MARKDOWN_MESSAGE_HEADER + code_block, parse_mode="Markdown")
+
+    # 4) Отправка cover letter
+    if cover_letter:
+        logger.info("[chat:%s] Step 4: Sending cover letter...", chat_id)
+        bot.send_message(chat_id, f"✉️ Short Cover Letter\n\n{cover_letter}")
+    else:
+        logger.warning("[chat:%s] No cover letter to send", chat_id)
+
+    # 5) Отправка PDF (рендерится параллельно с отправкой текстовых версий)
+    if pdf_future is not None:
+        try:
+            bot.edit_message_text("📄 Генерирую PDF-версию...", chat_id, status_message_id)
+            pdf_bytes = pdf_future.result()
+
+            logger.info("[chat:%s] Sending PDF to user...", chat_id)
+            safe_name = _UNSAFE_FILENAME_RE.sub("", resume_data["full_name"]).rstrip()
+            pdf_filename = f"Resume_{safe_name}.pdf"
+            logger.info("[chat:%s] PDF filename: %s", chat_id, pdf_filename)
+
+            bot.send_document(chat_id, pdf_bytes, visible_file_name=pdf_filename,
+                              caption="📄✨ Ваше резюме в формате PDF")
+            logger.info("[chat:%s] PDF sent successfully!", chat_id)
+
+            bot.delete_message(chat_id, status_message_id)
+
+        except Exception as e:
+            logger.exception("[chat:%s] PDF generation failed: %s", chat_id, e)
+            bot.send_message(chat_id, "⚠️ Не удалось сгенерировать PDF-версию резюме. Но текстовые версии готовы!")
+    else:
+        logger.warning("[chat:%s] full_name is empty or missing, skipping PDF generation", chat_id)
+        if logger.isEnabledFor(logging.DEBUG):
+            resume_data_dump = orjson.dumps(resume_data, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS).decode()
+            logger.debug("[chat:%s] resume_data content: %s", chat_id, resume_data_dump[:1000])
+        bot.delete_message(chat_id, status_message_id)
+
+
+def generate_resume_worker(chat_id: int, status_message_id: int, texts: list):
+    """
+    Генерирует резюме в пуле генерации, не занимая поток обработчика обновлений.
+    """
+    logger.info("[chat:%s] Processing %d text(s) from session", chat_id, len(texts))
+    full_text = normalize_user_text("\n\n".join(texts))
+    logger.info("[chat:%s] Combined text length: %d chars", chat_id, len(full_text))
+
+    try:
+        # 1) Вызов LLM
+        logger.info("[chat:%s] Step 1: Calling LLM...", chat_id)
+        messages = build_resume_messages(full_text)
+        progress = StreamProgressReporter(chat_id, status_message_id)
+
+        # 2) Парсинг JSON: выполняется внутри call_mistral, чтобы в кэш не попал битый ответ
+        def parse_response(raw: str) -> dict:
+            logger.info("[chat:%s] LLM response length: %d chars", chat_id, len(raw))
+            logger.info("[chat:%s] Step 2: Parsing JSON...", chat_id)
+            return extract_json(raw, chat_id)
+
+        try:
+            payload = call_mistral(messages, chat_id, on_progress=progress, parse=parse_response)
+        finally:
+            progress.wait()
+
+        # 3-5) Отправка результатов
+        deliver_resume(chat_id, status_message_id, payload)
+
+        logger.info("[chat:%s] ========== GENERATE RESUME COMPLETED ==========", chat_id)
+
+    except Exception as e:
+        logger.exception("[chat:%s] CRITICAL ERROR in generate_resume: %s", chat_id, e)
+        bot.edit_message_text("⚠️ Ошибка генерации. Попробуйте снова.", chat_id, status_message_id)
+
+
+@bot.message_handler(func=lambda m: m.text == BTN_GENERATE)
 def generate_resume(message):
     user_id = message.from_user.id
     chat_id = message.chat.id
 
-    logger.info(f"[chat:{chat_id}] ========== GENERATE RESUME STARTED ==========")
+    logger.info("[chat:%s] ========== GENERATE RESUME STARTED ==========", chat_id)
 
-    texts = user_sessions[user_id]["texts"]
-    if not texts:
-        logger.warning(f"[chat:{chat_id}] No texts in session, aborting")
+    # Сессия очищается сразу: повторное нажатие не запустит вторую генерацию,
+    # а тексты, присланные во время генерации, останутся для следующей
+    session_texts = take_session_texts(get_session(user_id))
+    if not session_texts:
+        logger.warning("[chat:%s] No texts in session, aborting", chat_id)
         bot.send_message(chat_id, "⚠️ Вы ещё не отправили данные.")
         return
 
-    logger.info(f"[chat:{chat_id}] Processing {len(texts)} text(s) from session")
-    full_text = "\n\n".join(texts)
-    logger.info(f"[chat:{chat_id}] Combined text length: {len(full_text)} chars")
+    logger.info("[chat:%s] Session cleared, took %d texts for generation", chat_id, len(session_texts))
 
     msg = bot.send_message(chat_id, "⏳ Анализирую ваши данные...")
+    generation_executor.submit(generate_resume_worker, chat_id, msg.message_id, session_texts)
 
-    try:
-        # 1) Вызов LLM
-        logger.info(f"[chat:{chat_id}] Step 1: Calling LLM...")
-        prompt = RESUME_JSON_PROMPT.replace("{user_text}", full_text)
-        raw = call_mistral(prompt, chat_id)
-        logger.info(f"[chat:{chat_id}] LLM response length: {len(raw)} chars")
-
-        # 2) Парсинг JSON
-        logger.info(f"[chat:{chat_id}] Step 2: Parsing JSON...")
-        payload = extract_json(raw, chat_id)
-
-        resume_markdown = (payload.get("resume_markdown") or "").strip()
-        cover_letter = (payload.get("cover_letter") or "").strip()
-        resume_data = payload.get("resume_data") or {}
-
-        logger.info(
-            f"[chat:{chat_id}] Parsed data - markdown: {len(resume_markdown)} chars, cover_letter: {len(cover_letter)} chars")
-        logger.info(f"[chat:{chat_id}] resume_data keys: {list(resume_data.keys())}")
-        logger.info(f"[chat:{chat_id}] full_name in resume_data: '{resume_data.get('full_name', 'NOT FOUND')}'")
-
-        # 3) Отправка резюме в Markdown
-        logger.info(f"[chat:{chat_id}] Step 3: Sending Markdown version...")
-        bot.edit_message_text("📄 Отправляю текстовую версию...", chat_id, msg.message_id)
-
-        if not resume_markdown:
-            logger.warning(f"[chat:{chat_id}] resume_markdown is empty!")
-            bot.send_message(chat_id, "⚠️ Не удалось получить resume_markdown из JSON.")
-        else:
-            code_block = wrap_markdown_code_block(resume_markdown)
-            if not code_block or len(f"📄 *Your Resume (Markdown)*\n\n{code_block}") > TELEGRAM_MESSAGE_LIMIT:
-                logger.info(f"[chat:{chat_id}] Sending markdown as file (too long or contains code blocks)")
-                file_buffer = BytesIO(resume_markdown.encode("utf-8"))
-                file_buffer.name = "resume.md"
-                bot.send_document(chat_id, file_buffer, caption="📄 Ваше резюме (Markdown файл)")
-            else:
-                logger.info(f"[chat:{chat_id}] Sending markdown as message")
-                message_text = f"📄 *Your Resume (Markdown)*\n\n{code_block}"
-                bot.send_message(chat_id, message_text, parse_mode="Markdown")
-
-        # 4) Отправка cover letter
-        if cover_letter:
-            logger.info(f"[chat:{chat_id}] Step 4: Sending cover letter...")
-            bot.send_message(chat_id, f"✉️ Short Cover Letter\n\n{cover_letter}")
-        else:
-            logger.warning(f"[chat:{chat_id}] No cover letter to send")
 
-        # 5) Генерация PDF
-        logger.info(f"[chat:{chat_id}] Step 5: PDF generation check...")
-        logger.info(f"[chat:{chat_id}] Checking if full_name exists: '{resume_data.get('full_name')}'")
+# ---------- Batch generation ----------
+def submit_batch_job(messages: list, chat_id: int, status_message_id: int) -> str:
+    """
+    Ставит запрос в очередь Batch API Mistral и возвращает id задачи.
+    """
+    row = {"custom_id": str(chat_id), "body": {"messages": messages}}
+    uploaded = mistral_client.files.upload(
+        file={
+            "file_name": f"resume_{chat_id}.jsonl",
+            "content": orjson.dumps(row)
+        },
+        purpose="batch"
+    )
+    job = mistral_client.batch.jobs.create(
+        input_files=[uploaded.id],
+        model=MISTRAL_MODEL,
+        endpoint="/v1/chat/completions",
+        # По metadata незавершённые задачи восстанавливаются после перезапуска бота
+        metadata={"chat_id": str(chat_id), "status_message_id": str(status_message_id)}
+    )
+    return job.id
 
-        if resume_data.get("full_name"):
-            logger.info(f"[chat:{chat_id}] full_name found, starting PDF generation...")
 
+def restore_batch_jobs():
+    """
+    Загружает в pending_batch_jobs незавершённые задачи, созданные до перезапуска.
+    """
+    restored = 0
+    page = 0
+    while True:
+        resp = mistral_client.batch.jobs.list(
+            page=page,
+            page_size=BATCH_LIST_PAGE_SIZE,
+            status=list(BATCH_PENDING_STATUSES)
+        )
+        jobs = resp.data or []
+        for job in jobs:
+            metadata = job.metadata or {}
             try:
-                bot.edit_message_text("📄 Генерирую PDF-версию...", chat_id, msg.message_id)
+                chat_id = int(metadata["chat_id"])
+                status_message_id = int(metadata["status_message_id"])
+            except (KeyError, TypeError, ValueError):
+                # Задача создана не ботом или без id статусного сообщения
+                continue
+            with pending_batch_jobs_lock:
+                pending_batch_jobs.setdefault(job.id, (chat_id, status_message_id))
+            restored += 1
+        if len(jobs) < BATCH_LIST_PAGE_SIZE:
+            break
+        page += 1
+
+    logger.info("Restored %d pending batch job(s)", restored)
+
+
+def fetch_batch_output(job) -> str:
+    """
+    Скачивает результат batch-задачи и возвращает текст ответа модели.
+    """
+    resp = mistral_client.files.download(file_id=job.output_file)
+    for line in resp.read().decode("utf-8").splitlines():
+        if line.strip():
+            row = orjson.loads(line)
+            return row["response"]["body"]["choices"][0]["message"]["content"]
+    raise ValueError("Batch output file is empty")
 
-                # Загрузка шрифтов
-                logger.info(f"[chat:{chat_id}] Loading fonts...")
-                import base64
 
-                try:
-                    with open("assets/fonts/Roboto-Regular.ttf", "rb") as f:
-                        resume_data["font_roboto_regular"] = base64.b64encode(f.read()).decode('utf-8')
-                    logger.info(f"[chat:{chat_id}] Roboto-Regular loaded")
-                except FileNotFoundError as e:
-                    logger.error(f"[chat:{chat_id}] Font file not found: {e}")
-                    raise
+def finish_batch_job(job, chat_id: int, status_message_id: int):
+    logger.info("[chat:%s] Batch job %s finished with status %s", chat_id, job.id, job.status)
 
-                try:
-                    with open("assets/fonts/Roboto-Bold.ttf", "rb") as f:
-                        resume_data["font_roboto_bold"] = base64.b64encode(f.read()).decode('utf-8')
-                    logger.info(f"[chat:{chat_id}] Roboto-Bold loaded")
-                except FileNotFoundError as e:
-                    logger.error(f"[chat:{chat_id}] Font file not found: {e}")
-                    raise
+    try:
+        if job.status != "SUCCESS" or not job.output_file:
+            raise RuntimeError(f"Batch job {job.id} did not produce output")
 
-                try:
-                    with open("assets/fonts/Roboto-Italic.ttf", "rb") as f:
-                        resume_data["font_roboto_italic"] = base64.b64encode(f.read()).decode('utf-8')
-                    logger.info(f"[chat:{chat_id}] Roboto-Italic loaded")
-                except FileNotFoundError as e:
-                    logger.error(f"[chat:{chat_id}] Font file not found: {e}")
-                    raise
+        raw = fetch_batch_output(job)
+        logger.info("[chat:%s] Batch response length: %d chars", chat_id, len(raw))
+        deliver_resume(chat_id, status_message_id, extract_json(raw, chat_id))
+    except Exception as e:
+        logger.error("[chat:%s] Batch delivery failed: %s", chat_id, e)
+        bot.edit_message_text("⚠️ Ошибка генерации. Попробуйте снова.", chat_id, status_message_id)
 
-                logger.info(f"[chat:{chat_id}] All fonts loaded successfully")
 
-                # Рендеринг HTML
-                logger.info(f"[chat:{chat_id}] Rendering HTML template...")
-                try:
-                    rendered_html = render_resume_html(resume_data)
-                    logger.info(f"[chat:{chat_id}] HTML rendered successfully, length: {len(rendered_html)} chars")
-                except Exception as e:
-                    logger.error(f"[chat:{chat_id}] HTML rendering error: {e}")
-                    import traceback
-                    logger.error(f"[chat:{chat_id}] Traceback: {traceback.format_exc()}")
-                    raise
+def poll_batch_jobs():
+    """
+    Фоновый цикл: проверяет статусы batch-задач и доставляет готовые резюме.
+    """
+    restored = False
+    while True:
+        if not restored:
+            try:
+                restore_batch_jobs()
+                restored = True
+            except Exception as e:
+                logger.error("Batch jobs restore failed: %s. Retrying in %d seconds...", e, BATCH_POLL_INTERVAL)
+
+        time.sleep(BATCH_POLL_INTERVAL)
 
-                # Конвертация в PDF
-                logger.info(f"[chat:{chat_id}] Converting HTML to PDF...")
+        with pending_batch_jobs_lock:
+            jobs = list(pending_batch_jobs.items())
+
+        for job_id, (chat_id, status_message_id) in jobs:
+            try:
+                job = mistral_client.batch.jobs.get(job_id=job_id)
+            except Exception as e:
+                logger.error("[chat:%s] Batch job %s status check failed: %s", chat_id, job_id, e)
+                continue
+
+            if job.status == "SUCCESS" or job.status in BATCH_FAILED_STATUSES:
+                with pending_batch_jobs_lock:
+                    pending_batch_jobs.pop(job_id, None)
+                # Ошибка доставки одному пользователю не должна останавливать поток для всех остальных
                 try:
-                    pdf_bytes = html_to_pdf_bytes(rendered_html)
-                    logger.info(f"[chat:{chat_id}] PDF generated successfully, size: {len(pdf_bytes)} bytes")
+                    finish_batch_job(job, chat_id, status_message_id)
                 except Exception as e:
-                    logger.error(f"[chat:{chat_id}] PDF conversion error: {e}")
-                    import traceback
-                    logger.error(f"[chat:{chat_id}] Traceback: {traceback.format_exc()}")
-                    raise
+                    logger.exception("[chat:%s] Batch job %s completion failed: %s", chat_id, job_id, e)
 
-                # Отправка PDF
-                logger.info(f"[chat:{chat_id}] Sending PDF to user...")
-                safe_name = "".join(c for c in resume_data["full_name"] if c.isalnum() or c in " _").rstrip()
-                pdf_filename = f"Resume_{safe_name}.pdf"
-                logger.info(f"[chat:{chat_id}] PDF filename: {pdf_filename}")
 
-                pdf_file_buffer = BytesIO(pdf_bytes)
-                pdf_file_buffer.name = pdf_filename
-                bot.send_document(chat_id, pdf_file_buffer, caption="📄✨ Ваше резюме в формате PDF")
-                logger.info(f"[chat:{chat_id}] PDF sent successfully!")
+@bot.message_handler(func=lambda m: m.text == BTN_GENERATE_BATCH)
+def generate_resume_batch(message):
+    user_id = message.from_user.id
+    chat_id = message.chat.id
 
-                bot.delete_message(chat_id, msg.message_id)
+    logger.info("[chat:%s] Batch generation requested", chat_id)
 
-            except Exception as e:
-                logger.error(f"[chat:{chat_id}] PDF generation failed: {e}")
-                import traceback
-                logger.error(f"[chat:{chat_id}] Full traceback:\n{traceback.format_exc()}")
-                bot.send_message(chat_id, "⚠️ Не удалось сгенерировать PDF-версию резюме. Но текстовые версии готовы!")
-        else:
-            logger.warning(f"[chat:{chat_id}] full_name is empty or missing, skipping PDF generation")
-            logger.warning(
-                f"[chat:{chat_id}] resume_data content: {json.dumps(resume_data, ensure_ascii=False, indent=2)[:1000]}")
-            bot.delete_message(chat_id, msg.message_id)
+    # Тексты забираются до отправки заявки: повторное нажатие не создаст вторую платную задачу
+    session_texts = take_session_texts(get_session(user_id))
+    if not session_texts:
+        logger.warning("[chat:%s] No texts in session, aborting", chat_id)
+        bot.send_message(chat_id, "⚠️ Вы ещё не отправили данные.")
+        return
+
+    full_text = normalize_user_text("\n\n".join(session_texts))
+    messages = build_resume_messages(full_text)
 
-        logger.info(f"[chat:{chat_id}] ========== GENERATE RESUME COMPLETED ==========")
+    msg = bot.send_message(chat_id, "🕐 Ставлю заявку в очередь...")
 
+    try:
+        job_id = submit_batch_job(messages, chat_id, msg.message_id)
     except Exception as e:
-        logger.error(f"[chat:{chat_id}] CRITICAL ERROR in generate_resume: {e}")
-        import traceback
-        logger.error(f"[chat:{chat_id}] Full traceback:\n{traceback.format_exc()}")
-        bot.edit_message_text("⚠️ Ошибка генерации. Попробуйте снова.", chat_id, msg.message_id)
+        # Тексты возвращаются в сессию, чтобы можно было сразу запустить обычную генерацию
+        logger.error("[chat:%s] Batch job submission failed: %s", chat_id, e)
+        restore_session_texts(get_session(user_id), session_texts)
+        bot.edit_message_text("⚠️ Не удалось поставить заявку в очередь. Попробуйте обычную генерацию.",
+                              chat_id, msg.message_id)
+        return
+
+    with pending_batch_jobs_lock:
+        pending_batch_jobs[job_id] = (chat_id, msg.message_id)
+    logger.info("[chat:%s] Batch job %s submitted", chat_id, job_id)
+
+    bot.edit_message_text(
+        "🕐 Заявка принята. Резюме придёт сюда, как только задача будет обработана (обычно в течение нескольких минут).",
+        chat_id, msg.message_id)
 
-    finally:
-        texts_count = len(user_sessions[user_id]["texts"])
-        user_sessions[user_id]["texts"].clear()
-        logger.info(f"[chat:{chat_id}] Session cleared, removed {texts_count} texts")
+
+# ---------- Webhook ----------
+class WebhookHandler(BaseHTTPRequestHandler):
+    """
+    Принимает обновления, которые Telegram отправляет POST-запросами.
+    """
+
+    def do_POST(self):
+        if self.path != WEBHOOK_PATH:
+            self.send_error(404)
+            return
+
+        secret = self.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+        # compare_digest не принимает str с не-ASCII символами: сравниваются байты
+        if not hmac.compare_digest(secret.encode("utf-8"), WEBHOOK_SECRET.encode("utf-8")):
+            logger.warning("Webhook request rejected: bad secret token from %s", self.client_address[0])
+            self.send_error(403)
+            return
+
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+        except ValueError:
+            length = -1
+        if length < 0:
+            self.send_error(400)
+            return
+
+        body = self.rfile.read(length).decode("utf-8")
+        self.send_response(200)
+        self.end_headers()
+
+        try:
+            # Обработчики уходят в пул потоков бота, ответ Telegram уже отправлен
+            bot.process_new_updates([Update.de_json(body)])
+        except Exception as e:
+            logger.error("Webhook update processing error: %s", e)
+
+    def log_message(self, format, *args):
+        logger.debug("Webhook: " + format, *args)
+
+
+def run_webhook():
+    while True:
+        try:
+            logger.info("Setting webhook to %s%s...", WEBHOOK_URL, WEBHOOK_PATH)
+            bot.set_webhook(url=f"{WEBHOOK_URL}{WEBHOOK_PATH}", secret_token=WEBHOOK_SECRET)
+            break
+        except Exception as e:
+            logger.error("Set webhook error: %s. Retrying in 3 seconds...", e)
+            time.sleep(3)
+
+    server = ThreadingHTTPServer((WEBHOOK_LISTEN, WEBHOOK_PORT), WebhookHandler)
+    logger.info("Listening for webhook updates on %s:%s", WEBHOOK_LISTEN, WEBHOOK_PORT)
+    server.serve_forever()
 
 
 # ---------- Stable polling ----------
@@ -386,14 +890,22 @@ def run_bot():
     logger.info("ResumeFlowBot is starting...")
     logger.info("========================================")
 
+    threading.Thread(target=poll_batch_jobs, name="batch-poller", daemon=True).start()
+
+    if WEBHOOK_URL:
+        run_webhook()
+        return
+
     while True:
         try:
+            # getUpdates не работает, пока установлен webhook
+            bot.remove_webhook()
             logger.info("Starting infinity_polling...")
-            bot.infinity_polling(timeout=10, long_polling_timeout=30)
+            bot.infinity_polling(timeout=10, long_polling_timeout=LONG_POLLING_TIMEOUT)
         except Exception as e:
-            logger.error(f"Polling error: {e}. Reconnecting in 3 seconds...")
+            logger.error("Polling error: %s. Reconnecting in 3 seconds...", e)
             time.sleep(3)
 
 
 if __name__ == "__main__":
-    run_bot()
\ No newline at end of file
+    run_bot()
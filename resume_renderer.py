@@ -1,8 +1,9 @@
 import os
+import atexit
 import asyncio
 import logging
+import threading
 from jinja2 import Environment, FileSystemLoader, select_autoescape
-from playwright.async_api import async_playwright
 
 # Logging setup
 logger = logging.getLogger(__name__)
@@ -10,55 +11,128 @@ logger = logging.getLogger(__name__)
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 TEMPLATE_DIR = os.path.join(BASE_DIR, "templates")
 
+# "playwright" (Chromium, по умолчанию) или "weasyprint" (без браузера, см. requirements.txt и Dockerfile)
+PDF_ENGINES = ("playwright", "weasyprint")
+PDF_ENGINE = os.getenv("PDF_ENGINE", "playwright").lower()
+if PDF_ENGINE not in PDF_ENGINES:
+    raise ValueError(f"Unknown PDF_ENGINE {PDF_ENGINE!r}, expected one of: {', '.join(PDF_ENGINES)}")
+
+if PDF_ENGINE == "weasyprint":
+    # Импорт при старте: без пакета или системных библиотек (Pango) бот не запустится,
+    # вместо того чтобы падать на каждом PDF
+    from weasyprint import CSS, HTML
+# Формат и поля страницы для WeasyPrint - те же, что передаются в page.pdf() для Chromium
+PDF_PAGE_CSS = "@page { size: Letter; margin: 40px 36px 45px 36px; }"
+
 env = Environment(
     loader=FileSystemLoader(TEMPLATE_DIR),
-    autoescape=select_autoescape(["html", "xml"])
+    autoescape=select_autoescape(["html", "xml"]),
+    auto_reload=False,
+    cache_size=400
 )
 
+# Шаблон компилируется один раз при импорте и переиспользуется для всех запросов
+RESUME_TEMPLATE = env.get_template("resume_pdf.html")
+
 
 def render_resume_html(resume_data: dict) -> str:
     """
     Рендерит HTML из Jinja-шаблона.
     """
-    logger.info("render_resume_html: Starting template rendering...")
-    logger.info(f"render_resume_html: Template dir: {TEMPLATE_DIR}")
-    logger.info(f"render_resume_html: resume_data keys: {list(resume_data.keys())}")
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("render_resume_html: resume_data keys: %s", list(resume_data.keys()))
 
     try:
-        template = env.get_template("resume_pdf.html")
-        logger.info("render_resume_html: Template loaded successfully")
-
-        result = template.render(**resume_data)
-        logger.info(f"render_resume_html: Template rendered, output length: {len(result)} chars")
+        result = RESUME_TEMPLATE.render(resume_data)
+        logger.debug("render_resume_html: Template rendered, output length: %d chars", len(result))
         return result
     except Exception as e:
-        logger.error(f"render_resume_html: Error rendering template: {e}")
+        logger.error("render_resume_html: Error rendering template: %s", e)
         raise
 
 
+# ---------- Browser pool ----------
+# Chromium запускается один раз и живёт в отдельном event loop в фоновом потоке;
+# на каждый PDF создаётся только новый контекст браузера
+_loop = None
+_loop_lock = threading.Lock()
+_playwright = None
+_browser = None
+_browser_lock = asyncio.Lock()
+
+
+def _get_loop() -> asyncio.AbstractEventLoop:
+    global _loop
+    with _loop_lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            threading.Thread(target=_loop.run_forever, name="pdf-renderer", daemon=True).start()
+        return _loop
+
+
+async def _get_browser():
+    global _playwright, _browser
+    async with _browser_lock:
+        if _browser is None or not _browser.is_connected():
+            if _playwright is None:
+                from playwright.async_api import async_playwright
+
+                logger.info("_get_browser: Starting playwright...")
+                _playwright = await async_playwright().start()
+            logger.info("_get_browser: Launching Chromium browser...")
+            _browser = await _playwright.chromium.launch(
+                headless=True,
+                args=['--no-sandbox', '--disable-setuid-sandbox']
+            )
+            logger.info("_get_browser: Browser launched successfully")
+        return _browser
+
+
+async def _close_browser():
+    global _playwright, _browser
+    if _browser is not None:
+        await _browser.close()
+        _browser = None
+    if _playwright is not None:
+        await _playwright.stop()
+        _playwright = None
+
+
+def close_browser():
+    """
+    Закрывает общий браузер и останавливает event loop рендерера.
+    """
+    if _loop is None:
+        return
+    try:
+        asyncio.run_coroutine_threadsafe(_close_browser(), _loop).result(timeout=10)
+    except Exception as e:
+        logger.warning("close_browser: Error while closing browser: %s", e)
+    _loop.call_soon_threadsafe(_loop.stop)
+
+
+atexit.register(close_browser)
+
+
 async def _html_to_pdf_playwright(html: str) -> bytes:
     """
     Асинхронно конвертирует HTML в PDF через Playwright.
     """
     logger.info("_html_to_pdf_playwright: Starting PDF conversion...")
-    logger.info(f"_html_to_pdf_playwright: Input HTML length: {len(html)} chars")
+    logger.info("_html_to_pdf_playwright: Input HTML length: %d chars", len(html))
 
     try:
-        logger.info("_html_to_pdf_playwright: Launching playwright...")
-        async with async_playwright() as p:
-            logger.info("_html_to_pdf_playwright: Launching Chromium browser...")
-            browser = await p.chromium.launch(
-                headless=True,
-                args=['--no-sandbox', '--disable-setuid-sandbox']
-            )
-            logger.info("_html_to_pdf_playwright: Browser launched successfully")
-
+        browser = await _get_browser()
+        context = await browser.new_context()
+        try:
             logger.info("_html_to_pdf_playwright: Creating new page...")
-            page = await browser.new_page()
+            page = await context.new_page()
             logger.info("_html_to_pdf_playwright: Page created")
 
             logger.info("_html_to_pdf_playwright: Setting page content...")
-            await page.set_content(html, wait_until='networkidle')
+            # HTML полностью самодостаточен (шрифты встроены в base64), ждать простоя сети не нужно
+            await page.set_content(html, wait_until='domcontentloaded')
+            await page.evaluate("document.fonts.ready")
             logger.info("_html_to_pdf_playwright: Content set successfully")
 
             logger.info("_html_to_pdf_playwright: Generating PDF...")
@@ -72,40 +146,35 @@ async def _html_to_pdf_playwright(html: str) -> bytes:
                     'left': '36px'
                 }
             )
-            logger.info(f"_html_to_pdf_playwright: PDF generated, size: {len(pdf_bytes)} bytes")
-
-            logger.info("_html_to_pdf_playwright: Closing browser...")
-            await browser.close()
-            logger.info("_html_to_pdf_playwright: Browser closed, returning PDF")
-
+            logger.info("_html_to_pdf_playwright: PDF generated, size: %d bytes", len(pdf_bytes))
             return pdf_bytes
+        finally:
+            await context.close()
 
     except Exception as e:
-        logger.error(f"_html_to_pdf_playwright: Error during PDF conversion: {e}")
-        import traceback
-        logger.error(f"_html_to_pdf_playwright: Traceback: {traceback.format_exc()}")
+        logger.error("_html_to_pdf_playwright: Error during PDF conversion: %s", e)
         raise
 
 
+def _html_to_pdf_weasyprint(html: str) -> bytes:
+    """
+    Конвертирует HTML в PDF через WeasyPrint, без запуска браузера.
+    """
+    return HTML(string=html, base_url=BASE_DIR).write_pdf(stylesheets=[CSS(string=PDF_PAGE_CSS)])
+
+
 def html_to_pdf_bytes(html: str) -> bytes:
     """
     Синхронная обёртка для конвертации HTML в PDF.
     """
-    logger.info("html_to_pdf_bytes: Starting sync wrapper...")
+    if PDF_ENGINE == "weasyprint":
+        logger.info("html_to_pdf_bytes: Converting with WeasyPrint...")
+        result = _html_to_pdf_weasyprint(html)
+        logger.info("html_to_pdf_bytes: Got result from WeasyPrint, size: %d bytes", len(result))
+        return result
 
-    try:
-        loop = asyncio.get_running_loop()
-        logger.info("html_to_pdf_bytes: Running loop detected, using ThreadPoolExecutor...")
-
-        import concurrent.futures
-        with concurrent.futures.ThreadPoolExecutor() as executor:
-            future = executor.submit(asyncio.run, _html_to_pdf_playwright(html))
-            result = future.result()
-            logger.info(f"html_to_pdf_bytes: Got result from executor, size: {len(result)} bytes")
-            return result
-
-    except RuntimeError:
-        logger.info("html_to_pdf_bytes: No running loop, using asyncio.run directly...")
-        result = asyncio.run(_html_to_pdf_playwright(html))
-        logger.info(f"html_to_pdf_bytes: Got result from asyncio.run, size: {len(result)} bytes")
-        return result
\ No newline at end of file
+    logger.info("html_to_pdf_bytes: Submitting conversion to renderer loop...")
+    future = asyncio.run_coroutine_threadsafe(_html_to_pdf_playwright(html), _get_loop())
+    result = future.result()
+    logger.info("html_to_pdf_bytes: Got result from renderer loop, size: %d bytes", len(result))
+    return result
@@ -0,0 +1,66 @@
+import time
+import threading
+from collections import OrderedDict
+
+
+class TTLCache:
+    """
+    Потокобезопасный LRU-кэш с ограничением по размеру и времени жизни записей.
+    """
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return default
+            expires_at, value = item
+            if expires_at <= time.monotonic():
+                del self._data[key]
+                return default
+            self._data.move_to_end(key)
+            return value
+
+    def _expire(self, now: float) -> None:
+        """
+        Удаляет просроченные записи из начала очереди, чтобы TTL ограничивал память,
+        даже если к этим ключам больше не обращаются. Вызывается под self._lock.
+        """
+        while self._data:
+            expires_at, _ = next(iter(self._data.values()))
+            if expires_at > now:
+                break
+            self._data.popitem(last=False)
+
+    def set(self, key, value) -> None:
+        with self._lock:
+            now = time.monotonic()
+            self._expire(now)
+            self._data[key] = (now + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def get_or_create(self, key, factory):
+        """
+        Возвращает значение по ключу, создавая его через factory при отсутствии.
+        Срок жизни записи при каждом обращении продлевается.
+        """
+        with self._lock:
+            item = self._data.get(key)
+            now = time.monotonic()
+            if item is None or item[0] <= now:
+                self._expire(now)
+                value = factory()
+            else:
+                value = item[1]
+            self._data[key] = (now + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+            return value